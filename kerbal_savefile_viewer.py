@@ -21,11 +21,27 @@ __version__ = 202404.29
 __author__ = 'IKJ'
 
 # --- Initialise ---
-from rich import print         # Print Formatting
-import argparse                # Argument Parsing
-import itertools               # Duplicate key handling
+# argparse and rich are only needed when running as main, so they are imported there.
 import json                    # JSON General Handling
+import codecs                  # Encoding names
 import io
+import re                      # SFS -> JSON munging
+import sys
+try:
+    import orjson              # Faster JSON Output, if installed
+except ImportError:
+    orjson = None
+
+
+# --- Constants ---
+_SFS_BRACE_FIX = re.compile(rb',\n"(\}+)')      # Fix Dedenting Braces, at any depth; ,\n"}}} --> }}},\n"
+_STRING_CONSTANTS = {                            # Strings with a fixed value when re-typed
+    'True': True, 'true': True,
+    'False': False, 'false': False,
+    'None': None, 'none': None,
+    'Infinity': 'Infinity',
+}
+_MISSING = object()                              # Sentinel for dictionary lookups
 
 
 # --- Functions ---
@@ -33,19 +49,22 @@ import io
 def _duplicate_object_hook(pairs):
     ''' Allows parsing a JSON with duplicate keys.
         {"key":"value", "key" : "value2"} --> { "key" : ["value", "value2"] }
-        https://stackoverflow.com/questions/29203165/dealing-with-json-with-duplicate-keys '''
-
-    def _key(pair):
-        (k, v) = pair
-        return k
-
-    def gpairs():
-        for (k, group) in itertools.groupby(pairs, _key):
-            ll = [v for (_, v) in group]
-            (v, *extra) = ll
-            yield (k, ll if extra else v)
-
-    return dict(gpairs())
+        https://stackoverflow.com/questions/29203165/dealing-with-json-with-duplicate-keys
+        Duplicates are grouped in a single pass, whether or not they are next to each other. '''
+    out = dict(pairs)      # Most objects have no duplicates, so build the dict in C first
+    if len(out) == len(pairs):
+        return out
+    out = {}
+    duplicates = set()     # Keys already turned into a list of values
+    for k, v in pairs:
+        if k not in out:
+            out[k] = v
+        elif k in duplicates:
+            out[k].append(v)
+        else:
+            out[k] = [out[k], v]
+            duplicates.add(k)
+    return out
 
 
 # Split a string reference path into a list, and convert any numbers to integers
@@ -58,73 +77,120 @@ def _tree_path_split(reference: str, branch: list = ["GAME"]) -> list[str, int]:
         return branch
     # Convert any numbers to integer type
     for count, step in enumerate(path):
-        try:
+        if (step[1:] if step[:1] == '-' else step).isdecimal():
             path[count] = int(step)
-        except ValueError:
-            pass
     return branch + path
 
 
 # Find a specific item from a path, given as a list
 def _dict_reference_from_list(data, keys: list):
-    """ Recursive function.
-        Return a value from a dictionary using a 'path' given as a list."""
-    if keys:
-        return _dict_reference_from_list(data[keys[0]], keys[1:])
-    else:
-        return data
+    """ Return a value from a dictionary using a 'path' given as a list."""
+    for key in keys:
+        data = data[key]
+    return data
 
 
 # --- SFS Handling ---
-def sfs_parse(sfs_file: io.TextIOWrapper | str) -> dict:
-    """ Convert an SFS file to a .json-compatible string. Then, parse using json.loads().
-        Expects either an opened text file (_io.TextIOWrapper) or string.
+def _utf8_buffer(sfs_file) -> io.BufferedIOBase | None:
+    """ Return the binary buffer under an opened text file, if reading it gives the same text the file would.
+        That is a UTF-8 text file with strict errors, that hasn't been read from yet. Returns None otherwise,
+        i.e. binary files, in-memory text files, pipes, or files opened with another encoding or errors setting. """
+    try:
+        buffer = sfs_file.buffer
+        if sfs_file.errors != 'strict' or codecs.lookup(sfs_file.encoding).name != 'utf-8':
+            return None
+        if sfs_file.tell() != 0:
+            return None
+        return buffer
+    except (AttributeError, OSError, LookupError):
+        return None
 
-        Works with a series of str.replace operations, which is fairly quick.
-        The alternative way to do this is to parse the .sfs line-by-line or char-by-char, as in 'sfsutils' by mark9064. """
 
-    # --- Type Checking ---
-    if type(sfs_file) == io.TextIOWrapper:
+def _read_sfs(sfs_file) -> bytes:
+    """ Read a whole opened .sfs file as bytes.
+        UTF-8 text files are read straight from their binary buffer, skipping the decode and re-encode through Python's
+        text layer. Other binary files are read as they are, and other text files are encoded to UTF-8. """
+    if (buffer := _utf8_buffer(sfs_file)) is not None:
+        sfs = buffer.read()
+    else:
         sfs = sfs_file.read()
-    elif type(sfs_file) != str:
-        print('Unexpected type passed to sfs_parse()', type(sfs_file))
-        return False
+        if isinstance(sfs, str):
+            return sfs.encode()
+    if b'\r' in sfs:      # Windows (or old Mac) line endings, which a text file would have translated
+        sfs = sfs.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    return sfs
+
 
-    # --- Convert to JSON formatting ---
+def _sfs_to_json(sfs: bytes) -> bytes:
+    """ Convert an .sfs file to .json-compatible bytes.
+        Each bytes.replace is a single C-level pass, which is faster than one regex pass with a Python callback per
+        token. Working on bytes rather than str keeps every pass on the fast path, even for non-ASCII saves. """
     # Clean Input String; remove tabs, whitespace at the end of lines
-    sfs = sfs.replace("\t", '').replace(" \n", '\n').replace('\n ', '\n')
+    sfs = sfs.translate(None, b'\t').replace(b' \n', b'\n').replace(b'\n ', b'\n')
 
     # Turn Node names into JSON Object Keys
-    sfs = sfs.replace('}\n', '}')      # i.e. Turn
-    sfs = sfs.replace('\n{', ':{')     # ...}\nTHING\n{... into
-    sfs = sfs.replace('{\n}', '{}\n')  # ...}, {"THING":{...
+    sfs = sfs.replace(b'}\n', b'}')      # i.e. Turn
+    sfs = sfs.replace(b'\n{', b':{')     # ...}\nTHING\n{... into
+    sfs = sfs.replace(b'{\n}', b'{}\n')  # ...}, {"THING":{...
 
     # Turn assignemnt (=) into key-value pairs
-    sfs = sfs.replace(' =\n', ' = \n')         # Ensure two spaces around assignment to an empty value
-    sfs = sfs.replace(' = ', '":"')            # Replace ' = ' with " : "
-    sfs = sfs.replace('\n', '",\n"')           # Add double-quotes at the start and end of newlines
-    sfs = sfs.replace(':{",', '":{')           # Fix misquoted objects and braces caused by the above
-    sfs = sfs.replace(':{}"', '":{}')          #     ''
-
-    for n in range(args.d):            # Fix Dedenting Braces
-        i = args.d - n                 # Deepest I can see is 8 or so. default 16 should be plenty
-        fr = ',\n"' + ('}' * i)        #    "}}}}} with <i> braces
-        to = ('}' * i) + ',\n"'        #    }}}}}" with <i> braces
-        sfs = sfs.replace(fr, to)
+    sfs = sfs.replace(b' =\n', b' = \n')        # Ensure two spaces around assignment to an empty value
+    sfs = sfs.replace(b' = ', b'":"')           # Replace ' = ' with " : "
+    sfs = sfs.replace(b'\n', b'",\n"')          # Add double-quotes at the start and end of newlines
+    sfs = sfs.replace(b':{",', b'":{')          # Fix misquoted objects and braces caused by the above
+    sfs = sfs.replace(b':{}"', b'":{}')         #     ''
+
+    # Fix Dedenting Braces. A callable is quicker than a r'\1' template, which is expanded in Python for every match
+    sfs = _SFS_BRACE_FIX.sub(lambda m: m.group(1) + b',\n"', sfs)
 
     # Fix start and end of file to make sure we have valid JSON
-    sfs = '{"' + sfs[:-3] + '}'
+    return b'{"' + sfs[:-3] + b'}'
+
+
+def _sfs_load(sfs_file: io.IOBase | str) -> dict:
+    """ Read, convert, and parse an opened .sfs file or string, as for sfs_parse().
+        Raises json.decoder.JSONDecodeError rather than printing it, so the command line can report it in order. """
+    sfs = sfs_file.encode() if isinstance(sfs_file, str) else _read_sfs(sfs_file)
+
+    # Now that we have a valid json-compatible string, convert it to JSON. json.loads() would decode bytes to a str
+    # internally anyway; doing it here lets each earlier copy be freed before the next one is made
+    sfs = _sfs_to_json(sfs)
+    sfs = sfs.decode()
+    return json.loads(sfs, object_pairs_hook=_duplicate_object_hook)
+
+
+def sfs_parse(sfs_file: io.IOBase | str) -> dict:
+    """ Convert an SFS file to a .json-compatible string. Then, parse using json.loads().
+        Expects either an opened file (anything with .read(), text or binary) or string. Files are expected in UTF-8.
+
+        Works with a series of bytes.replace operations, which is fairly quick.
+        The alternative way to do this is to parse the .sfs line-by-line or char-by-char, as in 'sfsutils' by mark9064. """
+
+    # --- Type Checking ---
+    if not isinstance(sfs_file, str) and not hasattr(sfs_file, 'read'):
+        print('Unexpected type passed to sfs_parse()', type(sfs_file))
+        return False
 
-    # Now that we have a valid json-compatible string, convert it to JSON
     try:
-        converted_sfs_file = json.loads(sfs, object_pairs_hook=_duplicate_object_hook)
-        return converted_sfs_file
+        return _sfs_load(sfs_file)
     except json.decoder.JSONDecodeError as d_err:
         print('Unable to convert! Error:')
         print('\t' + repr(d_err) + '\n')
         return False   # Something has Gone Wrong
 
 
+def json_dump(data: dict, indent: int | None = None, strings_only: bool = False) -> bytes:
+    """ Convert a Dictionary to .json, as UTF-8 bytes ready to write to a file.
+        If every value is a string (i.e. not re-typed), pass strings_only=True to use orjson if it is installed, which is
+        several times faster than json.dumps(). Re-typed data always uses json: orjson writes NaN and Infinity as null,
+        and can't encode integers beyond 64 bits.
+        orjson only supports an indent of 2, so any indent is treated as 2. It also writes non-ASCII characters as they
+        are, where json escapes them (i.e. \\u00e9); both read back the same. """
+    if strings_only and orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(data, indent=indent).encode()
+
+
 def sfs_dump():        # TODO
     """ Convert a Dictionary or .json to a .sfs-compatible string"""
     return
@@ -132,49 +198,56 @@ def sfs_dump():        # TODO
 
 # -- Data handling for the imported dictionary
 def inspect_data(data: dict, path: str | list):
-    if type(path) == str:
+    if isinstance(path, str):
         path = _tree_path_split(path)
 
     return _dict_reference_from_list(data, path)
 
 
 def retype_data(data, reverse=False):
-    # Recursively re-type a dictionary or list, to or from string to the appropriate type
-    def _recursive_apply(func, obj):
-        """ Recursively apply a given function to all items in a dict or list. """
-        if isinstance(obj, dict):      # if dict, apply to each key
-            return {k: _recursive_apply(func, v) for k, v in obj.items()}
-        elif isinstance(obj, list):    # if list, apply to each element
-            return [_recursive_apply(func, elem) for elem in obj]
-        else:
-            return func(obj)
+    # Re-type a dictionary or list in place, to or from string to the appropriate type
+    def _apply_inplace(func, root):
+        """ Apply a given function to all items in a dict or list, and any nested inside them.
+            Walks the tree with an explicit stack rather than recursion, so deep saves can't hit the recursion limit. """
+        if not isinstance(root, (dict, list)):
+            return func(root)
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict):     # if dict, apply to each key
+                for k, v in node.items():
+                    if isinstance(v, (dict, list)):
+                        stack.append(v)
+                    else:
+                        node[k] = func(v)
+            elif isinstance(node, list):   # if list, apply to each element
+                for i, v in enumerate(node):
+                    if isinstance(v, (dict, list)):
+                        stack.append(v)
+                    else:
+                        node[i] = func(v)
+        return root
 
     def _string_to_object(obj) -> any:
         """ Change a single object's type from string to the appropriate class. """
-        # Booleans
-        if obj in ('True', 'true'):
-            return True
-        elif obj in ('False', 'false'):
-            return False
-        elif obj in ('None', 'none'):
-            return None
-        # Infinity
-        elif obj == 'Infinity':
+        # Booleans, None, and Infinity
+        constant = _STRING_CONSTANTS.get(obj, _MISSING)
+        if constant is not _MISSING:
+            return constant
+        # Quaternions and Vectors. Strings with commas can't be numbers, so skip those checks
+        if ',' in obj:
+            if obj.count(',') in (2, 3):
+                try:
+                    return tuple(float(item) for item in obj.split(','))
+                except ValueError:
+                    pass
             return obj
-        # Quaternions and Vectors
-        try:
-            a = []
-            for item in obj.split(','):
-                a.append(float(item))
-            if len(a) == 3 or len(a) == 4:
-                return tuple(a)
-        except ValueError:
-            pass
         # Integers
-        try:
-            return int(obj)
-        except ValueError:
-            pass
+        if (obj[1:] if obj[:1] == '-' else obj).isdecimal():
+            try:
+                return int(obj)
+            except ValueError:     # Longer than sys.get_int_max_str_digits(); left to float()
+                pass
         # Float and NaN
         try:
             return float(obj)
@@ -187,7 +260,7 @@ def retype_data(data, reverse=False):
         """ Change a single object's type from a Bool, Number, or Tuple back to a string.
         TODO: Convert Lists like SCENARIO [ ... ] back to SCENARIO {}... SCENARIO {}... """
         # Booleans
-        if type(obj) == bool:
+        if isinstance(obj, bool):
             return str(obj)
         # Integers, Floats, and Strings
         else:
@@ -195,13 +268,79 @@ def retype_data(data, reverse=False):
 
     # Actual Function
     if not reverse:
-        return _recursive_apply(_string_to_object, data)
+        return _apply_inplace(_string_to_object, data)
     if reverse:
-        return _recursive_apply(_object_to_string, data)
+        return _apply_inplace(_object_to_string, data)
+
+
+# --- Command Line ---
+def _convert_one(path: str, args) -> list[tuple]:
+    """ Convert a single .sfs file to .json, as the command line does for each filepath given.
+        Runs in a worker process when several files are given, so the printouts are returned (as the arguments
+        for each print() call) to be printed in order by the main process, rather than printed here.
+        Requested objects are returned already rendered, as a plain string. See _print_printouts().
+        Parse errors, and saves without a GAME summary, are returned as printouts too, so they appear under their file's
+        name. """
+    printouts = [(f'[bold]{path}[/bold]' if args.pretty else path,)] if len(args.filepath) > 1 else []
+
+    # --- Parse and Load File ---
+    sfs_file = sys.stdin if path == '-' else open(path)
+    with sfs_file:
+        try:
+            jfs = _sfs_load(sfs_file)
+        except json.decoder.JSONDecodeError as d_err:      # Fail State
+            printouts.append(('Unable to convert! Error:',))
+            printouts.append(('\t' + repr(d_err) + '\n',))
+            return printouts
+
+    if args.x:         # Go through the entire tree and un-stringify all the numbers, constants, and vectors
+        jfs = retype_data(jfs)
+
+    # -- Printouts --
+    try:
+        game = jfs["GAME"]
+        title, timestamp, version = game[args.output_name], game[args.output_time], game[args.kspv]
+    except (KeyError, TypeError) as k_err:      # Fail State; not a KSP save
+        printouts.append(('Unable to read the save! Error:',))
+        printouts.append(('\t' + repr(k_err) + '\n',))
+        return printouts
+    printouts.append((f'[bold]{title}[/bold]\n' if args.pretty else f'{title}\n',))
+    printouts.append(("Save Time:\t", timestamp[:10], timestamp[11:16]))    # i.e. 2024-04-26T12:34:56
+    printouts.append(("KSP Version:\t", version, "\n"))
+
+    # - User Requested Items -
+    for reference in args.references:
+        if args.verbose:
+            printouts.append((reference,))
+        try:
+            printouts.append(str(inspect_data(jfs, reference)))
+        except (KeyError, IndexError, TypeError):
+            printouts.append(("Reference Failed, please check the spelling. This is case sensitive!",))
+
+    # -- Output to JSON file --
+    with open(sfs_file.name + '.json', 'wb') as file:
+        file.write(json_dump(jfs, indent=args.format, strings_only=not args.x))
+
+    return printouts
+
+
+def _print_printouts(printouts: list[tuple | str]):
+    """ Print the printouts returned by _convert_one(). Tuples are the arguments for print(), which may be rich.
+        Strings are requested objects, which can be very long (i.e. -q ALL), so they are written straight to stdout,
+        skipping rich's markup parsing and highlighting. """
+    for printout in printouts:
+        if isinstance(printout, str):
+            sys.stdout.write(printout)
+            sys.stdout.write('\n')
+        else:
+            print(*printout)
 
 
 # --- Running as Main ---
 if __name__ == '__main__':
+    import argparse            # Argument Parsing
+    import itertools
+    from concurrent.futures import ProcessPoolExecutor     # Converting several files at once
 
     # --- Configuration ---
     # - Command Line Arguments
@@ -211,16 +350,18 @@ if __name__ == '__main__':
         epilog=
         "Please note, using -q ALL or -r ALL may lag or crash, because they are very long. -x is not guaranteed to match the input perfectly due to floating point rounding"
     )
-    argp.add_argument('filepath', nargs='+', type=argparse.FileType('r'))
-    argp.add_argument('-d', metavar='[depth]', action='store', help='change max depth of the input .sfs file', type=int)
+    argp.add_argument('filepath', nargs='+', help='one or more .sfs files, converted in parallel')
+    argp.add_argument('-d', metavar='[depth]', action='store', help='deprecated, does nothing. (max depth of the input .sfs file is no longer limited)', type=int)
     argp.add_argument('-f', '--format', action='store_const', help='format the .json output with indenting and newlines', const=2)
     argp.add_argument('-x', action='store_true', help='recursively interpret non-strings as integers/floats/tuples') # TODO
     argp.add_argument('-t', '--testing', action='store_true', help='output intermediate step to text file (for debugging)')
+    argp.add_argument('-v', '--verbose', action='store_true', help='print the parsed arguments, and the path of each printout')
+    argp.add_argument('--pretty', action='store_true', help='format printouts with rich (slower to start)')
 
-    printouts = argp.add_argument_group('printouts', 'print an object. use / to get deeper into the tree, and integers for duplicate names.')
-    printouts.add_argument('-p', action='append', metavar='[ref/to/obj]', help='print an object inside "PARAMETERS", or ALL')
-    printouts.add_argument('-q', action='append', metavar='[ref/to/obj]', help='print an object inside "GAME", or ALL')
-    printouts.add_argument('-r', action='append', metavar='[ref/to/obj]', help='print an object inside "FLIGHTSTATE", or ALL')
+    printout_args = argp.add_argument_group('printouts', 'print an object. use / to get deeper into the tree, and integers for duplicate names.')
+    printout_args.add_argument('-p', action='append', metavar='[ref/to/obj]', help='print an object inside "PARAMETERS", or ALL')
+    printout_args.add_argument('-q', action='append', metavar='[ref/to/obj]', help='print an object inside "GAME", or ALL')
+    printout_args.add_argument('-r', action='append', metavar='[ref/to/obj]', help='print an object inside "FLIGHTSTATE", or ALL')
 
     # - Defaults
     argp.set_defaults(
@@ -231,16 +372,28 @@ if __name__ == '__main__':
         r=[],
         references=[],
         kspv='versionFull',
+        output_name='Title',
+        output_time='persistentTimestamp',
+        pretty=False,
         testing=False,
+        verbose=False,
         x=False,
     )
-    output_name = 'Title'
-    output_time = 'persistentTimestamp'
 
     # - Parse Args
     args = argp.parse_args()
-    filepath = args.filepath
-    print(args)
+    if args.filepath.count('-') > 1:
+        argp.error("argument filepath: '-' (stdin) can only be given once")
+    for path in args.filepath:     # Check every file opens, before starting on any of them
+        if path != '-':
+            try:
+                open(path).close()
+            except OSError as o_err:
+                argp.error(f"argument filepath: can't open '{path}': {o_err}")
+    if args.pretty:
+        from rich import print     # Print Formatting
+    if args.verbose:
+        print(args)
 
     # Assemble a list of paths within the sfs that the user wants to have printed to the screen.
     args.references = []
@@ -251,29 +404,12 @@ if __name__ == '__main__':
     for item in args.r:
         args.references.append(_tree_path_split(item, ["GAME", "FLIGHTSTATE"]))
 
-    # --- Parse and Load File ---
-    sfs = args.filepath[0]
-    jfs = sfs_parse(sfs)
-
-    if not jfs:        # Fail State
-        exit()         # Exit
-
-    if args.x:         # Go through the entire tree and un-stringify all the numbers, constants, and vectors
-        jfs = retype_data(jfs)
-
-    # -- Printouts --
-    print(f'[bold]{jfs["GAME"][output_name]}[/bold]\n')
-    print("Save Time:\t", jfs["GAME"][output_time][0:16].replace("T", " "))
-    print("KSP Version:\t", jfs["GAME"][args.kspv], "\n")
-
-    # - User Requested Items -
-    for reference in args.references:
-        print(reference)
-        try:
-            print(inspect_data(jfs, reference))
-        except KeyError as k_err:
-            print("Reference Failed, please check the spelling. This is case sensitive!")
-
-    # -- Output to JSON file --
-    with open(filepath[0].name + '.json', 'w') as file:
-        file.write(json.dumps(jfs, indent=args.format))
+    # --- Convert Files ---
+    # Each file is independent, so several are converted in separate processes. stdin can only be read from this one.
+    if len(args.filepath) > 1 and '-' not in args.filepath:
+        with ProcessPoolExecutor() as executor:
+            for printouts in executor.map(_convert_one, args.filepath, itertools.repeat(args)):
+                _print_printouts(printouts)
+    else:
+        for path in args.filepath:
+            _print_printouts(_convert_one(path, args))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Regression tests for kerbal_savefile_viewer. Run with: python -m unittest """
+
+import io
+import json
+import math
+import os
+import tempfile
+import unittest
+
+from kerbal_savefile_viewer import json_dump, retype_data, sfs_parse
+
+
+# A save with braces inside values, which aren't part of the node structure
+BRACES_IN_VALUES = (
+    'GAME\n'
+    '{\n'
+    '\tTitle = a}b\n'
+    '\tdescription = {x\n'
+    '\tFLIGHTSTATE\n'
+    '\t{\n'
+    '\t\tVESSEL\n'
+    '\t\t{\n'
+    '\t\t\tname = Ship } 1\n'
+    '\t\t}\n'
+    '\t}\n'
+    '}\n'
+)
+BRACES_IN_VALUES_PARSED = {
+    'GAME': {
+        'Title': 'a}b',
+        'description': '{x',
+        'FLIGHTSTATE': {'VESSEL': {'name': 'Ship } 1'}},
+    }
+}
+
+
+class TestBracesInValues(unittest.TestCase):
+    def test_string(self):
+        self.assertEqual(sfs_parse(BRACES_IN_VALUES), BRACES_IN_VALUES_PARSED)
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'persistent.sfs')
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(BRACES_IN_VALUES)
+            with open(path) as file:
+                self.assertEqual(sfs_parse(file), BRACES_IN_VALUES_PARSED)
+
+    def test_binary_file(self):
+        self.assertEqual(sfs_parse(io.BytesIO(BRACES_IN_VALUES.encode())), BRACES_IN_VALUES_PARSED)
+
+
+class TestJsonDump(unittest.TestCase):
+    def test_integer_beyond_64_bits(self):
+        data = {'GAME': {'seed': 123456789012345678901234}}
+        self.assertEqual(json.loads(json_dump(data)), data)
+        self.assertEqual(json.loads(json_dump(data, indent=2)), data)
+
+    def test_not_a_number(self):
+        data = json.loads(json_dump({'GAME': {'a': float('nan'), 'b': float('inf')}}))
+        self.assertTrue(math.isnan(data['GAME']['a']))
+        self.assertEqual(data['GAME']['b'], float('inf'))
+
+    def test_strings_only(self):
+        data = {'GAME': {'Title': 'Tëst Sävé', 'seed': '123456789012345678901234'}}
+        self.assertEqual(json.loads(json_dump(data, strings_only=True)), data)
+
+
+class TestRetypeData(unittest.TestCase):
+    def test_integer_too_long(self):
+        digits = '1' * 5000      # Over sys.get_int_max_str_digits(), 4300 by default
+        self.assertEqual(retype_data({'a': digits}), {'a': float(digits)})
+
+
+if __name__ == '__main__':
+    unittest.main()